@@ -3,9 +3,16 @@ TabPal, a TUI for adding and editing custom colour palettes for use in Tableau.
 """
 
 import os
+import re
+import tempfile
+from itertools import chain
 from platform import system
-from re import fullmatch
-import xml.etree.ElementTree as ET
+try:
+    # lxml parses and serialises in C (libxml2), which is noticeably faster
+    # on larger Preferences files.
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 from textual import on
 from textual.app import App
@@ -29,7 +36,9 @@ PALETTE_TYPES = {
     "ordered-diverging": "Diverging",
 }
 
-HEX_VALIDATION_REGEX = "^(#)?(?:[0-9a-fA-F]{6}){1}$"
+PALETTE_TYPES_REVERSE = {value: key for key, value in PALETTE_TYPES.items()}
+
+HEX_RE = re.compile(r"^#?[0-9a-fA-F]{6}$")
 
 
 # Validators.
@@ -37,8 +46,12 @@ class FilePath(Validator):
     """Verify the file path is valid."""
 
     def validate(self, value):
-        """Check the file path exists."""
-        if os.path.exists(value) and value.endswith("Preferences.tps"):
+        """Check the file path exists.
+
+        The suffix check comes first so obviously wrong paths are
+        rejected without a syscall; isfile then costs a single os.stat
+        and, unlike exists, rejects directories named Preferences.tps."""
+        if value.endswith("Preferences.tps") and os.path.isfile(value):
             return self.success()
         return self.failure()
 
@@ -48,7 +61,7 @@ class HexCode(Validator):
 
     def validate(self, hex_code):
         """Validate hex code entered."""
-        if fullmatch(HEX_VALIDATION_REGEX, hex_code):
+        if HEX_RE.fullmatch(hex_code):
             return self.success()
         return self.failure()
 
@@ -112,31 +125,17 @@ class AddPalette(Screen):
         """Add a new (blank) colour palette."""
 
         palette_name = self.query_one("#palette_name").value
-        existing_palettes_names = [
-            palette.get("name") for palette in self.app.existing_palettes
-        ]
 
-        palette_type = self.query_one("#palette_types").value
-        if palette_type == "Categorical":
-            palette_type = "regular"
-        elif palette_type == "Sequential":
-            palette_type = "ordered-sequential"
-        elif palette_type == "Diverging":
-            palette_type = "ordered-diverging"
-
-        if palette_name not in existing_palettes_names and palette_name != "":
-            with open(self.app.preferences_file, "r", encoding="UTF-8") as f:
-                tree = ET.parse(f)
-                parent_tag = tree.find("preferences")
-                element = ET.Element(
-                    "color-palette", {"name": palette_name, "type": palette_type}
-                )
-                parent_tag.append(element)
-
-            tree.write(
-                self.app.preferences_file, encoding="utf-8", xml_declaration=True
+        palette_type = PALETTE_TYPES_REVERSE[self.query_one("#palette_types").value]
+
+        if palette_name not in self.app._palettes_by_name and palette_name != "":
+            parent_tag = self.app._tree.find("preferences")
+            element = ET.Element(
+                "color-palette", {"name": palette_name, "type": palette_type}
             )
-            self.dismiss(self.app.preferences_file)
+            parent_tag.append(element)
+            self.app._flush_tree()
+            self.dismiss(palette_name)
 
 
 class TabPal(App):
@@ -153,34 +152,16 @@ class TabPal(App):
     def __init__(self):
         super().__init__()
         self.preferences_file = self.find_preferences_file()
+        self._tree = self._parse_preferences_file()
         self.existing_palettes = self.get_existing_palettes()
+        self._last_viz_palette = None
         self.dark = False
 
     # App functions.
     def compose(self):
         """Construct a user interface with widgets."""
 
-        try:
-            existing_palettes_names = [
-                Option(palette.get("name"), id="test")
-                for palette in self.existing_palettes
-            ]
-            existing_palettes_types = [
-                Option(PALETTE_TYPES.get(palette.get("type")), disabled=True, id="test")
-                for palette in self.existing_palettes
-            ]
-            seperators = [Separator() for item in existing_palettes_names]
-            existing_palettes = [
-                item
-                for container in zip(
-                    existing_palettes_names, existing_palettes_types, seperators
-                )
-                for item in container
-            ]
-            yield OptionList(*existing_palettes, id="existing_palettes")
-
-        except TypeError:  # No custom colour palettes exist in the Preferences file.
-            yield OptionList(id="existing_palettes")
+        yield OptionList(*self._palette_options(), id="existing_palettes")
 
         yield Vertical(
             OptionList(id="existing_colours"),
@@ -204,191 +185,243 @@ class TabPal(App):
     def find_preferences_file(self):
         """Look in the usual spots for the Preferences file."""
 
-        WINDOWS_USUAL_PATH = (
-            rf"C:\Users\{os.getlogin()}\Documents\My Tableau Repository\Preferences.tps"
-        )
-        MAC_USUAL_PATH = (
-            rf"/Users/{os.getlogin()}/Documents/My Tableau Repository/Preferences.tps"
-        )
+        variable_file_path = os.environ.get("TAB_PAL_FILE")
+        if variable_file_path is not None:
+            if variable_file_path.endswith("Preferences.tps"):
+                return variable_file_path
+            return None
 
-        try:
-            if not (VARIABLE_FILE_PATH := os.environ["TAB_PAL_FILE"]).endswith(
-                "Preferences.tps"
-            ):
-                return None
-            return VARIABLE_FILE_PATH
-        except KeyError:
-            if system() == "Darwin":
-                if os.path.exists(MAC_USUAL_PATH):
-                    return MAC_USUAL_PATH
-            if system() == "Windows":
-                if os.path.exists(WINDOWS_USUAL_PATH):
-                    return WINDOWS_USUAL_PATH
+        # os.getlogin() and system() are both syscalls, so only look
+        # them up once and only build the path for the current OS.
+        sys_name = system()
+        if sys_name == "Darwin":
+            usual_path = (
+                f"/Users/{os.getlogin()}/Documents/My Tableau Repository"
+                "/Preferences.tps"
+            )
+        elif sys_name == "Windows":
+            usual_path = (
+                rf"C:\Users\{os.getlogin()}\Documents\My Tableau Repository"
+                r"\Preferences.tps"
+            )
+        else:
             return None
 
-    def get_existing_palettes(self):
-        """Get the existing custom colour palettes from the user's
-        Preferences file."""
+        if os.path.isfile(usual_path):
+            return usual_path
+        return None
+
+    def _parse_preferences_file(self):
+        """Parse the Preferences file into an ElementTree.
+
+        The tree is kept in memory and mutated directly - disk is only
+        touched when writing changes back."""
 
-        # Open Preferences file.
         try:
             with open(self.preferences_file, "r", encoding="UTF-8") as f:
-                tree = ET.parse(f)
-        # Preferences file can't be found. Note that in order for on_mount()
-        # to execute a value needs to be returned to the app's
-        # existing_palettes attribute, hence None being returned.
+                return ET.parse(f)
+        # Preferences file can't be found.
         except TypeError:
             return None
 
-        # Parse Preferences file.
+    def _flush_tree(self):
+        """Write the in-memory Preferences tree to disk atomically.
+
+        The tree is serialised once to a temporary file in the same
+        directory, which is then renamed over the Preferences file so a
+        crash mid-write can't leave it half-written."""
+
+        payload = ET.tostring(
+            self._tree.getroot(), encoding="utf-8", xml_declaration=True
+        )
+        directory = os.path.dirname(os.path.abspath(self.preferences_file))
+        with tempfile.NamedTemporaryFile(mode="wb", dir=directory, delete=False) as f:
+            f.write(payload)
+        os.replace(f.name, self.preferences_file)
+
+    def get_existing_palettes(self):
+        """Get the existing custom colour palettes from the in-memory
+        copy of the user's Preferences file."""
+
+        # Preferences file can't be found.
+        if self._tree is None:
+            self._palettes_by_name = {}
+            return []
+
+        # Walk the tree. iter() is a direct C-level iterator, avoiding the
+        # XPath compilation findall() pays per call.
         palettes = []
-        for palette in tree.findall(".//color-palette"):
-            palette_name = palette.attrib.get("name")
-            palette_type = palette.attrib.get("type")
-            colours = [colour.text for colour in palette.findall("./color")]
+        for palette in self._tree.getroot().iter("color-palette"):
+            palette_name = palette.get("name")
+            palette_type = palette.get("type")
+            colours = [colour.text for colour in palette.iter("color")]
+            # Keep a reference to the palette's element so mutations don't
+            # need an XPath search over the tree.
             palettes.append(
-                {"name": palette_name, "type": palette_type, "colours": colours}
+                {
+                    "name": palette_name,
+                    "type": palette_type,
+                    "colours": colours,
+                    "colours_set": set(colours),
+                    "_elem": palette,
+                }
             )
+        # Index the palettes by name so lookups on every highlight/keystroke
+        # are O(1) rather than a linear scan.
+        self._palettes_by_name = {palette["name"]: palette for palette in palettes}
         return palettes
 
     def add_new_colour(self, palette_name, hex_code):
         """Add a new colour to the selected palette in the Preferences file."""
 
-        with open(self.preferences_file, "r", encoding="UTF-8") as f:
-            tree = ET.parse(f)
-            parent_tag = tree.find(f'.//color-palette[@name="{palette_name}"]')
-            element = ET.Element("color")
-            element.text = hex_code
-            parent_tag.append(element)
+        parent_tag = self._palettes_by_name[palette_name]["_elem"]
+        element = ET.Element("color")
+        element.text = hex_code
+        parent_tag.append(element)
 
-        tree.write(self.preferences_file, encoding="utf-8", xml_declaration=True)
+        self._flush_tree()
 
-    def refresh_palette_colours(self):
-        """Refresh the palette's list of colours pane."""
-        selected_option = (
-            self.query_one("#existing_palettes")
-            .get_option_at_index(self.query_one("#existing_palettes").highlighted)
-            .prompt
-        )
-        existing_colours = [
-            palette.get("colours")
-            for palette in self.existing_palettes
-            if palette.get("name") == selected_option
-        ][0]
-        options = [Option(colour) for colour in existing_colours]
-        self.query_one("#existing_colours").clear_options()
-        self.query_one("#existing_colours").add_options(options)
+    def _refresh_selected_palette(self):
+        """Refresh the colours list and visualisation panes for the
+        currently highlighted palette.
+
+        Both panes show the same palette, so the highlight and palette
+        lookups are done once and shared."""
+
+        palettes_list = self.query_one("#existing_palettes", OptionList)
+        colours_list = self.query_one("#existing_colours", OptionList)
+        viz = self.query_one("#colour_palettes_viz")
+
+        # No palette highlighted (when a palette is deleted or no custom
+        # colour palettes exist).
+        if palettes_list.highlighted is None:
+            colours_list.clear_options()
+            viz.remove_children()
+            self._last_viz_palette = None
+            return
+
+        highlighted_palette = palettes_list.get_option_at_index(
+            palettes_list.highlighted
+        ).prompt
+        colours = self._palettes_by_name[highlighted_palette]["colours"]
+
+        colours_list.clear_options()
+        colours_list.add_options([Option(colour) for colour in colours])
+
+        # Nothing the visualisation shows has changed, so skip the rebuild.
+        viz_palette = (highlighted_palette, tuple(colours))
+        if viz_palette == self._last_viz_palette:
+            return
+        self._last_viz_palette = viz_palette
+
+        labels = []
+        for colour in colours:
+            label = Label(colour, classes="viz_labels")
+            label.styles.background = colour
+            labels.append(label)
+
+        # Set styles before mounting and batch the swap so Textual only
+        # performs a single layout pass.
+        with self.batch_update():
+            viz.remove_children()
+            viz.mount(*labels)
 
     def refresh_palettes(self, preferences_file):
         """Refreshes the existing colour palettes list in the app's
         pane."""
 
         self.preferences_file = preferences_file
+        if self._tree is None:
+            self._tree = self._parse_preferences_file()
         self.existing_palettes = self.get_existing_palettes()
+        self._rebuild_palette_options()
 
-        options_list = self.query_one("#existing_palettes")
-        options_list.clear_options()
-        existing_palettes_names = [
-            Option(palette.get("name")) for palette in self.existing_palettes
-        ]
-        existing_palettes_types = [
-            Option(PALETTE_TYPES.get(palette.get("type")), disabled=True)
-            for palette in self.existing_palettes
-        ]
-        seperators = [Separator() for item in existing_palettes_names]
-        existing_palettes = [
-            item
-            for container in zip(
-                existing_palettes_names, existing_palettes_types, seperators
+    def _palette_options(self):
+        """Yield the name/type/separator rows for every existing palette."""
+
+        return chain.from_iterable(
+            (
+                Option(palette["name"]),
+                Option(PALETTE_TYPES[palette["type"]], disabled=True),
+                Separator(),
             )
-            for item in container
-        ]
-        options_list.add_options(existing_palettes)
+            for palette in self.existing_palettes
+        )
 
-    def refresh_visualisation(self):
-        """Refresh the visualisation pane with the current selected palette's
-        colours."""
-        viz = self.query_one("#colour_palettes_viz")
-        viz.remove_children()
+    def _rebuild_palette_options(self):
+        """Rebuild the colour palettes pane from scratch."""
 
-        try:
-            highlighted_palette = (
-                self.query_one("#existing_palettes")
-                .get_option_at_index(self.query_one("#existing_palettes").highlighted)
-                .prompt
-            )
-            highlighted_palette_colours = [
-                colour
-                for colour in self.existing_palettes
-                if colour.get("name") == highlighted_palette
-            ][0]["colours"]
-
-            labels = []
-            for colour in highlighted_palette_colours:
-                label = Label(colour, classes="viz_labels")
-                label.styles.background = colour
-                labels.append(label)
+        options_list = self.query_one("#existing_palettes", OptionList)
+        options_list.clear_options()
+        options_list.add_options(self._palette_options())
 
-            viz.mount(*labels)
-        # No palette highlighted (when a palette is deleted or no custom colour
-        # palettes exist.
-        except TypeError:
-            pass
+    def _append_palette_option(self, palette):
+        """Append a single palette's rows to the colour palettes pane,
+        rather than rebuilding the whole list."""
+
+        self.query_one("#existing_palettes", OptionList).add_options(
+            [
+                Option(palette.get("name")),
+                Option(PALETTE_TYPES.get(palette.get("type")), disabled=True),
+                Separator(),
+            ]
+        )
+
+    def _palette_added(self, palette_name):
+        """Register a newly added palette in the colour palettes pane."""
+
+        self.existing_palettes = self.get_existing_palettes()
+        self._append_palette_option(self._palettes_by_name[palette_name])
 
     # Keys.
     def action_delete(self):
         """Delete the selected palette or palette colour."""
 
-        with open(self.preferences_file, "r", encoding="UTF-8") as f:
-            tree = ET.parse(f)
-        root = tree.getroot()
-        preferences = root.find("preferences")
+        palettes_list = self.query_one("#existing_palettes", OptionList)
+        # No palette highlighted, so nothing to delete.
+        if palettes_list.highlighted is None:
+            return None
 
-        highlighted_colour_palette = (
-            self.query_one("#existing_palettes")
-            .get_option_at_index(self.query_one("#existing_palettes").highlighted)
-            .prompt
-        )
-        colour_palette = preferences.find(
-            f""".//color-palette[@name="{highlighted_colour_palette}"]"""
-        )
+        highlighted_colour_palette = palettes_list.get_option_at_index(
+            palettes_list.highlighted
+        ).prompt
+        colour_palette = self._palettes_by_name[highlighted_colour_palette]["_elem"]
 
-        try:
-            highlighted_colour = (
-                self.query_one("#existing_colours")
-                .get_option_at_index(self.query_one("#existing_colours").highlighted)
-                .prompt
-            )
+        colours_list = self.query_one("#existing_colours", OptionList)
+        if colours_list.highlighted is not None:
+            highlighted_colour = colours_list.get_option_at_index(
+                colours_list.highlighted
+            ).prompt
             colour = [
                 colour for colour in colour_palette if colour.text == highlighted_colour
             ][0]
             colour_palette.remove(colour)
-            tree.write(self.preferences_file, encoding="utf-8", xml_declaration=True)
-            self.query_one("#existing_colours").clear_options()
+            self._flush_tree()
             self.existing_palettes = self.get_existing_palettes()
-            self.refresh_palette_colours()
-            self.refresh_visualisation()
+            self._refresh_selected_palette()
             return None
 
-        except TypeError:  # No colour highlighted.
-            preferences.remove(colour_palette)
-            tree.write(self.preferences_file, encoding="utf-8", xml_declaration=True)
-            self.refresh_palettes(self.preferences_file)
-            self.query_one("#existing_colours").clear_options()
-            self.refresh_visualisation()
-            return None
+        # No colour highlighted, so delete the whole palette.
+        preferences = self._tree.getroot().find("preferences")
+        preferences.remove(colour_palette)
+        self._flush_tree()
+        # OptionList can't remove separator rows individually, so the
+        # pane has to be rebuilt when a palette is deleted.
+        self.existing_palettes = self.get_existing_palettes()
+        self._rebuild_palette_options()
+        self._refresh_selected_palette()
+        return None
 
     def action_add_palette(self):
         """Add a new colour palette."""
-        self.push_screen(AddPalette(self), self.refresh_palettes)
+        self.push_screen(AddPalette(self), self._palette_added)
 
     # Widget interaction.
     @on(OptionList.OptionSelected, "#existing_palettes")
     def option_selected(self):
         """Refresh colours palette list and visualisation pane
         when a new colour palette is selected."""
-        self.refresh_palette_colours()
-        self.refresh_visualisation()
+        self._refresh_selected_palette()
 
     @on(OptionList.OptionHighlighted, "#existing_palettes")
     def option_highlighted(self):
@@ -399,42 +432,33 @@ class TabPal(App):
         the app (as an option is highlighted, but not selected, when the widget
         is added to the app on launch.)
         """
-        self.refresh_palette_colours()
-        self.refresh_visualisation()
+        self._refresh_selected_palette()
 
     @on(Input.Submitted, "#add_code")
     def process_input(self):
         """Add hex code to highlighted colour palette."""
-        try:
-            selected_option_index = self.query_one("#existing_palettes").highlighted
-            highlighted_colour_palette = (
-                self.query_one("#existing_palettes")
-                .get_option_at_index(selected_option_index)
-                .prompt
-            )
+        palettes_list = self.query_one("#existing_palettes", OptionList)
+        # No colour palette highlighted to add the code to.
+        if palettes_list.highlighted is None:
+            return
+
+        highlighted_colour_palette = palettes_list.get_option_at_index(
+            palettes_list.highlighted
+        ).prompt
+        palette_colours = self._palettes_by_name[highlighted_colour_palette][
+            "colours_set"
+        ]
 
-            palette_colours = [
-                palette.get("colours")
-                for palette in self.existing_palettes
-                if palette.get("name") == highlighted_colour_palette
-            ][0]
+        hex_code_input = self.query_one("#add_code", Input)
+        hex_code = hex_code_input.value
+        if len(hex_code) < 7:
+            hex_code = "#" + hex_code
+        if HEX_RE.fullmatch(hex_code) and hex_code not in palette_colours:
+            self.add_new_colour(highlighted_colour_palette, hex_code)
+            self.existing_palettes = self.get_existing_palettes()
+            hex_code_input.clear()
 
-            hex_code_input = self.query_one("#add_code")
-            hex_code = hex_code_input.value
-            if len(hex_code) < 7:
-                hex_code = "#" + hex_code
-            if (
-                fullmatch(HEX_VALIDATION_REGEX, hex_code)
-                and hex_code not in palette_colours
-            ):
-                self.add_new_colour(highlighted_colour_palette, hex_code)
-                self.existing_palettes = self.get_existing_palettes()
-                hex_code_input.clear()
-
-                self.refresh_palette_colours()
-                self.refresh_visualisation()
-        except TypeError:  # No colour palette list exists.
-            pass
+            self._refresh_selected_palette()
 
 
 # Entry point script.